@@ -67,6 +67,81 @@ options:
               manager.
         default:
         type: str
+    download_only:
+        description:
+            - Whether or not to only download the package(s) without
+              installing them. Packages from the official repositories are
+              fetched into the pacman's cache, while snapshots and sources of
+              AUR packages are fetched inside the C(aur_cache_dir) directory
+              (with C(makepkg --verifysource), so neither the dependencies are
+              installed nor the packages are built), so that the later install
+              or upgrade does not need to download them again. AUR packages
+              are prefetched only when no pacman's wrapper is installed.
+              Cannot be used in combination with the C(absent) state.
+        default: no
+        type: bool
+    aur_cache_dir:
+        description:
+            - Path to the directory where AUR packages are downloaded and
+              built when no pacman's wrapper is installed.
+        default: ~/.cache/pacaur
+        type: path
+    cache_retention:
+        description:
+            - Number of the most recent versions of every package that should
+              be kept in the pacman's cache and in the C(aur_cache_dir)
+              directory after the package(s) have been actually installed or
+              the system upgraded. Older versions are removed, equivalent of
+              'I(paccache -r -k N)'. The caches are not pruned when the option
+              is not set or when nothing has been changed.
+        type: int
+    lock_timeout:
+        description:
+            - Maximum time in seconds to wait for the package database lock
+              held by another package manager process before executing the
+              transaction. Read-only package queries are not blocked by the
+              lock.
+        default: 300
+        type: int
+    aur_url:
+        description:
+            - Base URL of the AUR (or a compatible mirror) used for the RPC
+              requests and for downloading the package snapshots.
+        default: https://aur.archlinux.org
+        type: str
+    index_helper:
+        description:
+            - Path to the Unix socket of the package index helper, the
+              long-lived process that keeps the installed packages, the
+              official repositories content and the AUR package details in
+              memory between the module runs. The helper can be started on
+              the managed host with 'I(python pacaur.py --serve-index PATH
+              --socket-group GROUP)'. The socket should be placed in the
+              directory owned by root (or by the module's user) that is not
+              writable by anyone else, eg. C(/run/pacaur) with the 0750 mode,
+              and it is used only when it is owned by root or by the module's
+              user. The AUR package details are taken from the helper only
+              when it serves the same AUR as the aur_url option (see its
+              '--aur-url' option). When the helper is not available, all the
+              package details are resolved by the module itself.
+        type: path
+    metrics:
+        description:
+            - Whether or not to measure every command and URL request executed
+              by the module and return their totals grouped by the execution
+              phases (classification, refresh, planning, build and
+              transaction).
+        default: no
+        type: bool
+    trace_file:
+        description:
+            - Path to the JSON file where the collected metrics together with
+              details of every executed command and URL request should be
+              written. Implies C(metrics).
+        type: path
+
+requirements:
+    - zstandard (optional, to read details of the .pkg.tar.zst local packages without calling pacman)
 
 author:
     - Tomasz Choroba (@devourerOfBits80)
@@ -143,6 +218,24 @@ EXAMPLES = '''
   become: yes
   become_user: non-root-user
 
+# Download packages to the cache before the maintenance window
+- name: Prefetch packages foo and aur-foo
+  pacaur:
+    name:
+      - foo
+      - aur-foo
+    state: latest
+    download_only: yes
+  become: yes
+  become_user: non-root-user
+
+# Upgrade the whole system and keep only two versions of each cached package
+- name: Upgrade the system and prune the package cache
+  pacaur:
+    upgrade: yes
+    update_cache: yes
+    cache_retention: 2
+
 # Remove desired packages
 - name: Remove packages foo, bar and aur-foo
   pacaur:
@@ -193,6 +286,13 @@ EXAMPLES = '''
     update_cache: yes
   become: yes
   become_user: non-root-user
+
+# Download all package upgrades without installing them
+- name: Execute the equivalent of 'I(pacman -Syuw)' command as a separate step
+  pacaur:
+    upgrade: yes
+    update_cache: yes
+    download_only: yes
 '''
 
 RETURN = '''
@@ -204,21 +304,62 @@ handler:
     description: path to the system application that executed required action
     returned: when action is related to install or upgrade package(s)
     type: str
+reclaimed_bytes:
+    description: number of bytes reclaimed by pruning the writable package caches (others are skipped with a warning)
+    returned: when the cache_retention option is set and package(s) have been installed or the system upgraded
+    type: int
+lock_wait:
+    description: time in seconds spent waiting for the package database lock
+    returned: when a transaction has been executed
+    type: float
+metrics:
+    description: number, duration and size of the output of the executed commands and URL requests, grouped by the
+                 execution phases and by the command classes; the phase durations are measured on the main thread
+                 and the time spent by the background workers is reported as C(background)
+    returned: when the metrics or trace_file option is set
+    type: dict
 '''
 
 
+import argparse
+import io
 import json
 import os
 import re
+import shutil
+import socket
+import socketserver
+import stat
+import subprocess
+import sys
 import tarfile
-import tempfile
+import threading
+import time
 import urllib.parse
+import urllib.request
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import cmp_to_key
 
 from ansible.module_utils.basic import AnsibleModule
 from ansible.module_utils.urls import open_url
 
+try:
+    import zstandard
+    HAS_ZSTANDARD = True
+except ImportError:
+    HAS_ZSTANDARD = False
+
+
+local_package_pattern = r'^.+\.pkg\.tar(\.(?P<compression>gz|bz2|xz|zst|lrz|lzo|Z))?$'
 
-package_version_pattern = '-[0-9].*$'
+streamable_compressions = [None, 'gz', 'bz2', 'xz']
+
+package_archive_errors = (OSError, EOFError, tarfile.TarError, UnicodeDecodeError) + \
+    ((zstandard.ZstdError,) if HAS_ZSTANDARD else ())
+
+cached_package_pattern = r'^(?P<name>.+)-(?P<version>[^-]+-[^-]+)-(?P<arch>[^-]+)\.pkg\.tar(\.[^.]+)?$'
 
 state_equivalents = {
     'absent': 'removed',
@@ -229,19 +370,466 @@ state_equivalents = {
 pacman_wrappers = {
     'yay': {
         'install': ['-S', '--needed', '--noconfirm', '--noprogressbar', '--cleanafter'],
-        'upgrade': ['-S', '-u', '-q', '--noconfirm']
+        'upgrade': ['-S', '-u', '-q', '--noconfirm'],
+        'prefiltered': ['--nodevel']
     },
     'pikaur': {
         'install': ['-S', '--needed', '--noconfirm', '--noprogressbar', '--noedit'],
-        'upgrade': ['-S', '-u', '-q', '--noconfirm']
+        'upgrade': ['-S', '-u', '-q', '--noconfirm'],
+        'prefiltered': []
     },
     'trizen': {
         'install': ['-S', '--needed', '--noconfirm', '--noprogressbar', '--noedit'],
-        'upgrade': ['-S', '-u', '-q', '--noconfirm']
+        'upgrade': ['-S', '-u', '-q', '--noconfirm'],
+        'prefiltered': []
     }
 }
 
 
+execution_phases = ['classification', 'refresh', 'planning', 'build', 'transaction']
+
+
+pacman_config_values = {}
+
+
+def classify_command(args):
+    '''
+    Retrieve class of the command, built from the executable name and its leading options.
+    '''
+    args = args.split() if isinstance(args, str) else list(args)
+    executable = os.path.basename(args[0]) if args else ''
+    arguments = args[1:]
+
+    if executable == 'sudo':
+        while arguments and arguments[0].startswith('-'):
+            arguments = arguments[1:]
+
+        if arguments:
+            executable = 'sudo {}'.format(os.path.basename(arguments[0]))
+            arguments = arguments[1:]
+
+    options = [item for item in arguments if item.startswith('-')][:2]
+    return ' '.join([executable] + options)
+
+
+def classify_url(url):
+    '''
+    Retrieve class of the URL request, built from the host name and the first path segment.
+    '''
+    parsed_url = urllib.parse.urlparse(url)
+    return '{}/{}'.format(parsed_url.netloc, parsed_url.path.strip('/').split('/')[0])
+
+
+class Instrumentation(object):
+    '''
+    Collect duration, exit code and output size of every command and URL request executed by the module, together with
+    the time spent in every execution phase. Phase durations are measured on the main thread only, so they sum up to
+    the module run time; the time spent by the background workers is reported separately.
+    '''
+
+    def __init__(self):
+        self.enabled = False
+        self.records = []
+        self.phase_durations = dict((phase, 0.0) for phase in execution_phases)
+        self.background_duration = 0.0
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def install(self, module):
+        '''
+        Start measuring the commands executed by the module and attach the metrics to its result.
+        '''
+        run_command = module.run_command
+        exit_json = module.exit_json
+        fail_json = module.fail_json
+
+        def instrumented_run_command(args, *posargs, **kwargs):
+            started = time.monotonic()
+            rc, stdout, stderr = run_command(args, *posargs, **kwargs)
+            size = len((stdout or '').encode('utf8', 'replace')) + len((stderr or '').encode('utf8', 'replace'))
+            self.record('command', classify_command(args), started, rc, size, args if isinstance(args, str)
+                        else ' '.join(args))
+            return (rc, stdout, stderr)
+
+        def instrumented_exit_json(**kwargs):
+            kwargs['metrics'] = self.finish(module)
+            exit_json(**kwargs)
+
+        def instrumented_fail_json(**kwargs):
+            kwargs['metrics'] = self.finish(module)
+            fail_json(**kwargs)
+
+        module.run_command = instrumented_run_command
+        module.exit_json = instrumented_exit_json
+        module.fail_json = instrumented_fail_json
+        self.enabled = True
+        self.started = time.monotonic()
+        self.local.switched = self.started
+
+    def record(self, kind, category, started, code, size, target):
+        '''
+        Store details of the executed command or URL request.
+        '''
+        with self.lock:
+            self.records.append({
+                'kind': kind,
+                'class': category,
+                'target': target,
+                'phase': getattr(self.local, 'phase', 'planning'),
+                'start': round(started - self.started, 6),
+                'duration': round(time.monotonic() - started, 6),
+                'code': code,
+                'bytes': size
+            })
+
+    def switch_phase(self, phase):
+        '''
+        Switch the execution phase of the current thread and return the previous one.
+        '''
+        now = time.monotonic()
+        previous = getattr(self.local, 'phase', 'planning')
+
+        with self.lock:
+            if threading.current_thread() is threading.main_thread():
+                self.phase_durations[previous] += now - getattr(self.local, 'switched', now)
+            else:
+                self.background_duration += now - getattr(self.local, 'switched', now)
+
+        self.local.phase = phase
+        self.local.switched = now
+        return previous
+
+    @contextmanager
+    def phase(self, phase):
+        '''
+        Assign the commands and URL requests executed within the context to the given phase.
+        '''
+        previous = self.switch_phase(phase)
+
+        try:
+            yield
+        finally:
+            self.switch_phase(previous)
+
+    def request_url(self, url):
+        '''
+        Open the URL and return its whole content as a stream.
+        '''
+        started = time.monotonic()
+        response = open_url(url)
+        content = response.read()
+
+        if self.enabled:
+            self.record('request', classify_url(url), started, response.getcode(), len(content), url)
+
+        return io.BytesIO(content)
+
+    def finish(self, module):
+        '''
+        Summarize the collected records and write them into the trace file, if it has been requested.
+        '''
+        self.switch_phase(getattr(self.local, 'phase', 'planning'))
+        phases = dict((phase, {'duration': round(duration, 6), 'commands': 0, 'requests': 0, 'bytes': 0})
+                      for phase, duration in self.phase_durations.items())
+        classes = {}
+
+        for item in self.records:
+            phases[item['phase']]['commands' if item['kind'] == 'command' else 'requests'] += 1
+            phases[item['phase']]['bytes'] += item['bytes']
+            totals = classes.setdefault(item['class'], {'count': 0, 'duration': 0.0, 'bytes': 0, 'failures': 0})
+            totals['count'] += 1
+            totals['duration'] = round(totals['duration'] + item['duration'], 6)
+            totals['bytes'] += item['bytes']
+            totals['failures'] += 1 if item['code'] not in (0, 200) else 0
+
+        metrics = {
+            'duration': round(time.monotonic() - self.started, 6),
+            'commands': sum(item['commands'] for item in phases.values()),
+            'requests': sum(item['requests'] for item in phases.values()),
+            'background': round(self.background_duration, 6),
+            'phases': phases,
+            'classes': classes
+        }
+
+        if module.params['trace_file']:
+            try:
+                with open(module.params['trace_file'], 'w') as stream:
+                    json.dump({'metrics': metrics, 'records': self.records}, stream, indent=2)
+            except (IOError, OSError) as e:
+                module.warn('could not write the trace file: {}'.format(e))
+
+        return metrics
+
+
+instrumentation = Instrumentation()
+
+
+class PackageIndex(object):
+    '''
+    Package indexes kept in memory by the helper process. The installed packages and the official repositories content
+    are reloaded when the package databases change, the AUR package details expire after the given time.
+    '''
+
+    def __init__(self, pacman, db_path, aur_url, aur_ttl):
+        self.pacman = pacman
+        self.db_path = db_path
+        self.aur_url = aur_url
+        self.aur_ttl = aur_ttl
+        self.signature = None
+        self.installed = {}
+        self.provided = {}
+        self.repository = {}
+        self.groups = {}
+        self.official = {}
+        self.aur = {}
+        self.lock = threading.Lock()
+
+    def run_pacman(self, *args):
+        '''
+        Execute pacman and return the lines of its output.
+        '''
+        return [item.split() for item in self.read_pacman(*args).split('\n') if item.strip()]
+
+    def read_pacman(self, *args):
+        '''
+        Execute pacman and return its whole output.
+        '''
+        process = subprocess.run([self.pacman] + list(args), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                 env=dict(os.environ, LC_ALL='C'), universal_newlines=True)
+        return process.stdout
+
+    def is_official_package(self, name):
+        '''
+        Determine if the package is available in the official repositories, with using the same search as the module
+        itself (so names matched by the provides or the description are accepted as well).
+        '''
+        if name not in self.official:
+            ere = '^{}$'.format(re.escape(name))
+            process = subprocess.run([self.pacman, '-S', '-s', ere], stdout=subprocess.DEVNULL,
+                                     stderr=subprocess.DEVNULL, env=dict(os.environ, LC_ALL='C'))
+            self.official[name] = process.returncode == 0
+
+        return self.official[name]
+
+    def get_signature(self):
+        '''
+        Retrieve modification times of the local and the sync package databases.
+        '''
+        paths = [os.path.join(self.db_path, 'local')]
+        sync_path = os.path.join(self.db_path, 'sync')
+
+        if os.path.isdir(sync_path):
+            paths.extend(sorted(os.path.join(sync_path, item) for item in os.listdir(sync_path)))
+
+        return tuple((item, os.stat(item).st_mtime_ns) for item in paths if os.path.exists(item))
+
+    def refresh(self):
+        '''
+        Reload the installed packages and the official repositories content if the package databases have changed.
+        '''
+        signature = self.get_signature()
+
+        if signature == self.signature:
+            return
+
+        self.installed = {}
+        self.provided = {}
+
+        for package_info in parse_pacman_info_output(self.read_pacman('-Q', '-i')):
+            if 'Name' in package_info and 'Version' in package_info:
+                self.installed[package_info['Name']] = package_info['Version']
+
+                for item in package_info.get('Provides', '').split():
+                    if item != 'None':
+                        self.provided.setdefault(item.split('=')[0], package_info['Version'])
+
+        self.repository = {}
+        self.groups = {}
+        self.official = {}
+
+        for item in self.run_pacman('-S', '-l'):
+            if len(item) > 2:
+                self.repository.setdefault(item[1], item[2])
+
+        for item in self.run_pacman('-S', '-g', '-g'):
+            if len(item) > 1:
+                self.groups.setdefault(item[0], []).append(item[1])
+
+        self.signature = signature
+
+    def get_aur_packages_info(self, names):
+        '''
+        Retrieve the AUR package details, requesting only these which are not known yet or have already expired.
+        '''
+        now = time.monotonic()
+        missing = [name for name in names if name not in self.aur or self.aur[name][0] + self.aur_ttl < now]
+
+        for index in range(0, len(missing), 100):
+            chunk = missing[index:index + 100]
+            query = '&'.join('arg[]={}'.format(urllib.parse.quote(name)) for name in chunk)
+            url = '{}/rpc/?v=5&type=info&{}'.format(self.aur_url.rstrip('/'), query)
+
+            with urllib.request.urlopen(url, timeout=30) as response:
+                results = dict((item['Name'], item) for item in json.loads(response.read().decode('utf8'))['results'])
+
+            for name in chunk:
+                self.aur[name] = (now, results.get(name))
+
+        return dict((name, self.aur[name][1]) for name in names)
+
+    def query(self, query, names, aur_url=None):
+        '''
+        Answer the query about the given package names. The AUR package details are refused when the client expects
+        them from another AUR than the one served by the helper.
+        '''
+        with self.lock:
+            if query == 'aur':
+                if aur_url and aur_url.rstrip('/') != self.aur_url.rstrip('/'):
+                    raise ValueError('the package index helper serves the AUR at {}'.format(self.aur_url))
+
+                return self.get_aur_packages_info(names)
+
+            self.refresh()
+
+            if query == 'installed':
+                return dict((name, self.installed.get(name, self.provided.get(name))) for name in names)
+
+            if query == 'repository':
+                return dict((name, self.repository.get(name)) for name in names)
+
+            if query == 'groups':
+                return dict((name, self.groups.get(name, [])) for name in names)
+
+            if query == 'official':
+                return dict((name, self.is_official_package(name)) for name in names)
+
+        raise ValueError('unknown query: {}'.format(query))
+
+
+class PackageIndexRequestHandler(socketserver.StreamRequestHandler):
+    '''
+    Handle a single JSON request sent to the package index helper.
+    '''
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode('utf8'))
+            response = {'result': self.server.package_index.query(request['query'], request['names'],
+                                                                  request.get('aur_url'))}
+        except Exception as e:
+            response = {'error': str(e)}
+
+        self.wfile.write(json.dumps(response).encode('utf8') + b'\n')
+
+
+class PackageIndexClient(object):
+    '''
+    Query the package index helper, if it has been configured and it is reachable.
+    '''
+
+    def __init__(self):
+        self.socket_path = None
+
+    def connect(self, socket_path):
+        '''
+        Configure path to the Unix socket of the package index helper. The socket is used only if it is owned by root
+        or by the current user and it is placed in the directory that cannot be modified by anyone else, otherwise the
+        reason of rejecting it is returned.
+        '''
+        self.socket_path = None
+
+        if not socket_path or not os.path.exists(socket_path):
+            return None
+
+        trusted_owners = (0, os.geteuid())
+        socket_stat = os.stat(socket_path)
+        directory_stat = os.stat(os.path.dirname(os.path.abspath(socket_path)))
+
+        if not stat.S_ISSOCK(socket_stat.st_mode) or socket_stat.st_uid not in trusted_owners:
+            return 'the package index helper socket is not owned by root or by the current user'
+
+        if directory_stat.st_uid not in trusted_owners or directory_stat.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+            return 'the package index helper socket is placed in the directory writable by other users'
+
+        self.socket_path = socket_path
+        return None
+
+    def query(self, query, names, aur_url=None):
+        '''
+        Send the query to the helper and return its result, or None when the helper is not available or it cannot
+        answer the query (eg. it serves another AUR than the given one).
+        '''
+        if not self.socket_path:
+            return None
+
+        request = {'query': query, 'names': names}
+
+        if aur_url:
+            request['aur_url'] = aur_url
+
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+                connection.settimeout(60)
+                connection.connect(self.socket_path)
+                connection.sendall(json.dumps(request).encode('utf8') + b'\n')
+                response = json.loads(connection.makefile('rb').readline().decode('utf8'))
+
+            if 'error' in response:
+                return None
+
+            return response['result']
+        except (OSError, ValueError, KeyError):
+            # Fall back to resolving everything in-process for the rest of this run.
+            self.socket_path = None
+            return None
+
+
+package_index = PackageIndexClient()
+
+
+def serve_package_index(socket_path, pacman, db_path, aur_url, aur_ttl, idle_timeout, socket_group=None):
+    '''
+    Run the package index helper until it stays idle for the given time. The socket is accessible only for its owner
+    and for the members of the given group.
+    '''
+    if os.path.exists(socket_path):
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+                connection.connect(socket_path)
+
+            sys.exit('package index helper is already running at {}'.format(socket_path))
+        except OSError:
+            os.remove(socket_path)
+
+    previous_umask = os.umask(0o117)
+
+    try:
+        server = socketserver.ThreadingUnixStreamServer(socket_path, PackageIndexRequestHandler)
+    finally:
+        os.umask(previous_umask)
+
+    if socket_group:
+        shutil.chown(socket_path, group=socket_group)
+
+    os.chmod(socket_path, 0o660)
+    server.package_index = PackageIndex(pacman, db_path, aur_url, aur_ttl)
+    server.timeout = idle_timeout or None
+    server.idle = False
+
+    def handle_timeout():
+        server.idle = True
+
+    server.handle_timeout = handle_timeout
+
+    try:
+        while not server.idle:
+            server.handle_request()
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+
+
 def get_pacman_wrapper(module):
     '''
     Retrieve one of the predefined pacman's wrapper to have the direct AUR support.
@@ -258,13 +846,18 @@ def get_pacman_wrapper(module):
     return pacman_wrapper
 
 
-def get_pacman_wrapper_command(wrapper, upgrade_mode=False):
+def get_pacman_wrapper_command(wrapper, upgrade_mode=False, prefiltered=False):
     '''
-    Retrieve command to install or upgrade packages with using the wrapper.
+    Retrieve command to install or upgrade packages with using the wrapper. For the package list already filtered by
+    the module, the wrapper's own redundant checks are skipped where it is supported.
     '''
     cmd = [wrapper]
     action = 'upgrade' if upgrade_mode else 'install'
     cmd.extend(pacman_wrappers[wrapper.split('/')[-1]][action])
+
+    if prefiltered:
+        cmd.extend(pacman_wrappers[wrapper.split('/')[-1]]['prefiltered'])
+
     return cmd
 
 
@@ -309,6 +902,64 @@ def split_extra_args(extra_args_str):
     return extra_args
 
 
+def get_pacman_config_values(module, key):
+    '''
+    Retrieve value(s) of the pacman's configuration option, asking pacman-conf only once per option during the run.
+    '''
+    if key in pacman_config_values:
+        return pacman_config_values[key]
+
+    values = []
+    pacman_conf = module.get_bin_path('pacman-conf')
+
+    if pacman_conf:
+        rc, stdout, _ = module.run_command([pacman_conf, key], check_rc=False)
+
+        if rc == 0:
+            values = [item.strip() for item in stdout.split('\n') if item.strip()]
+
+    pacman_config_values[key] = values
+    return values
+
+
+def get_pacman_lock_file(module):
+    '''
+    Retrieve path to the package database lock file.
+    '''
+    db_path = get_pacman_config_values(module, 'DBPath')
+    return os.path.join(db_path[0] if db_path else '/var/lib/pacman/', 'db.lck')
+
+
+def run_transaction_command(module, cmd, result, phase='transaction', **kwargs):
+    '''
+    Execute the command that modifies the package database, waiting (with backoff) while the database lock is held by
+    another process.
+    '''
+    with instrumentation.phase(phase):
+        lock_file = get_pacman_lock_file(module)
+        deadline = time.monotonic() + module.params['lock_timeout']
+        delay = 0.5
+        retry = False
+
+        while True:
+            started = time.monotonic()
+
+            while (retry or os.path.exists(lock_file)) and time.monotonic() < deadline:
+                # The lock may be held at the path that is not visible here (eg. another root directory), so every
+                # retry of the failed command waits with the same backoff as the lock file polling.
+                time.sleep(max(min(delay, deadline - time.monotonic()), 0))
+                delay = min(delay * 2, 10)
+                retry = False
+
+            result['lock_wait'] = round(result.get('lock_wait', 0) + time.monotonic() - started, 3)
+            rc, stdout, stderr = module.run_command(cmd, check_rc=False, **kwargs)
+
+            if rc == 0 or 'unable to lock database' not in stderr or time.monotonic() >= deadline:
+                return (rc, stdout, stderr)
+
+            retry = True
+
+
 def refresh_package_databases(module, pacman, result):
     '''
     Refresh the master package databases for the official repositories.
@@ -329,13 +980,189 @@ def refresh_package_databases(module, pacman, result):
     if not (params['name'] or params['upgrade']):
         cmd.extend(split_extra_args(params['extra_args']))
 
-    rc, _, stderr = module.run_command(cmd, check_rc=False)
+    rc, _, stderr = run_transaction_command(module, cmd, result, 'refresh')
 
     if rc != 0:
         result['msg'] = 'could not refresh the master package databases: {}'.format(stderr)
         module.fail_json(**result)
 
 
+def compare_version_segments(version_a, version_b):
+    '''
+    Compare two version segments with using the same rules as the rpmvercmp function of the libalpm.
+    '''
+    if version_a == version_b:
+        return 0
+
+    def is_alnum(string, index):
+        return index < len(string) and string[index].isascii() and string[index].isalnum()
+
+    def is_alpha(string, index):
+        return index < len(string) and string[index].isascii() and string[index].isalpha()
+
+    def is_digit(string, index):
+        return index < len(string) and string[index].isascii() and string[index].isdigit()
+
+    one = two = 0
+    end_a = end_b = 0
+
+    while one < len(version_a) and two < len(version_b):
+        while one < len(version_a) and not is_alnum(version_a, one):
+            one += 1
+
+        while two < len(version_b) and not is_alnum(version_b, two):
+            two += 1
+
+        if one >= len(version_a) or two >= len(version_b):
+            break
+
+        if one - end_a != two - end_b:
+            return -1 if one - end_a < two - end_b else 1
+
+        end_a, end_b = one, two
+        is_number = is_digit(version_a, end_a)
+        is_segment_char = is_digit if is_number else is_alpha
+
+        while is_segment_char(version_a, end_a):
+            end_a += 1
+
+        while is_segment_char(version_b, end_b):
+            end_b += 1
+
+        if end_b == two:
+            return 1 if is_number else -1
+
+        segment_a = version_a[one:end_a]
+        segment_b = version_b[two:end_b]
+
+        if is_number:
+            segment_a = segment_a.lstrip('0')
+            segment_b = segment_b.lstrip('0')
+
+            if len(segment_a) != len(segment_b):
+                return 1 if len(segment_a) > len(segment_b) else -1
+
+        if segment_a != segment_b:
+            return -1 if segment_a < segment_b else 1
+
+        one, two = end_a, end_b
+
+    if one >= len(version_a) and two >= len(version_b):
+        return 0
+
+    if (one >= len(version_a) and not is_alpha(version_b, two)) or is_alpha(version_a, one):
+        return -1
+
+    return 1
+
+
+def split_package_version(version):
+    '''
+    Split the package version into epoch, version and release.
+    '''
+    epoch = '0'
+    release = None
+    match = re.match(r'^([0-9]*):', version)
+
+    if match:
+        epoch = match.group(1) or '0'
+        version = version[match.end():]
+
+    if '-' in version:
+        version, release = version.rsplit('-', 1)
+
+    return (epoch, version, release)
+
+
+def compare_package_versions(version_a, version_b):
+    '''
+    Compare two package versions, equivalent of the 'I(vercmp)' command.
+    '''
+    if version_a == version_b:
+        return 0
+
+    epoch_a, pkgver_a, release_a = split_package_version(version_a)
+    epoch_b, pkgver_b, release_b = split_package_version(version_b)
+    compared = compare_version_segments(epoch_a, epoch_b)
+
+    if compared == 0:
+        compared = compare_version_segments(pkgver_a, pkgver_b)
+
+    if compared == 0 and release_a and release_b:
+        compared = compare_version_segments(release_a, release_b)
+
+    return compared
+
+
+def get_pacman_cache_directories(module):
+    '''
+    Retrieve the pacman's cache directories.
+    '''
+    return get_pacman_config_values(module, 'CacheDir') or ['/var/cache/pacman/pkg/']
+
+
+def prune_package_cache(directory, retention):
+    '''
+    Remove all except the given number of the most recent versions of every package from the cache directory and
+    return the number of reclaimed bytes.
+    '''
+    cached_files = {}
+    cached_versions = {}
+    reclaimed_bytes = 0
+
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            package_file = entry.name[:-len('.sig')] if entry.name.endswith('.sig') else entry.name
+            match = re.match(cached_package_pattern, package_file)
+
+            if match and entry.is_file(follow_symlinks=False):
+                cached_files.setdefault(package_file, []).append((entry.path, entry.stat().st_size))
+                versions = cached_versions.setdefault((match.group('name'), match.group('arch')), {})
+                versions.setdefault(match.group('version'), set()).add(package_file)
+
+    for versions in cached_versions.values():
+        ordered_versions = sorted(versions, key=cmp_to_key(compare_package_versions), reverse=True)
+
+        for version in ordered_versions[retention:]:
+            for package_file in versions[version]:
+                for path, size in cached_files[package_file]:
+                    try:
+                        os.remove(path)
+                        reclaimed_bytes += size
+                    except OSError:
+                        pass
+
+    return reclaimed_bytes
+
+
+def prune_package_caches(module, result):
+    '''
+    Prune the pacman's cache and the AUR packages cache, if it has been requested. Called only after the package(s)
+    have been actually installed or the system upgraded, so pruning never happens for an unchanged result.
+    '''
+    retention = module.params['cache_retention']
+
+    if retention is None:
+        return
+
+    directories = []
+
+    for directory in get_pacman_cache_directories(module):
+        if os.access(directory, os.W_OK):
+            directories.append(directory)
+        elif os.path.isdir(directory):
+            module.warn('the pacman\'s cache directory {} is not writable, so it has not been pruned'.format(
+                directory))
+
+    aur_cache_directory = module.params['aur_cache_dir']
+
+    if os.path.isdir(aur_cache_directory) and os.access(aur_cache_directory, os.W_OK):
+        with os.scandir(aur_cache_directory) as entries:
+            directories.extend(entry.path for entry in entries if entry.is_dir(follow_symlinks=False))
+
+    result['reclaimed_bytes'] = sum(prune_package_cache(item, retention) for item in directories)
+
+
 def return_update_cache_result(module, submsg, result):
     '''
     Prepare and return result for the update cache option.
@@ -350,7 +1177,8 @@ def return_upgrade_result(module, submsg, result):
     Prepare and return result for the upgrade option.
     '''
     result['changed'] = True
-    result['msg'] = 'system {} upgraded'.format(submsg)
+    result['msg'] = 'system upgrade {} downloaded'.format(submsg) if module.params['download_only'] \
+        else 'system {} upgraded'.format(submsg)
     module.exit_json(**result)
 
 
@@ -376,14 +1204,21 @@ def upgrade(module, pacman, result):
         result['msg'] = 'system is up to date'
         module.exit_json(**result)
 
+    if module.params['download_only']:
+        cmd.append('-w')
+
     cmd.extend(split_extra_args(module.params['extra_args']))
-    rc, _, stderr = module.run_command(cmd, check_rc=False)
+    rc, _, stderr = run_transaction_command(module, cmd, result)
 
     if rc != 0:
         result['msg'] = 'could not upgrade the system: {}'.format(stderr)
         module.fail_json(**result)
 
     result['handler'] = handler
+
+    if not module.params['download_only']:
+        prune_package_caches(module, result)
+
     return_upgrade_result(module, 'has been', result)
 
 
@@ -391,23 +1226,124 @@ def is_local_package(package):
     '''
     Determine if the package is a filename of the local package file.
     '''
-    return re.match(r'^.+\.pkg\.tar(\.(gz|bz2|xz|lrz|lzo|Z))?$', package)
+    return re.match(local_package_pattern, package)
 
 
-def get_aur_package_info(package):
+def parse_package_info(stream):
+    '''
+    Parse the content of the .PKGINFO file.
+    '''
+    package_info = {}
+
+    for line in stream.read().decode('utf8').split('\n'):
+        line = line.strip()
+
+        if line and not line.startswith('#') and ' = ' in line:
+            key, value = line.split(' = ', 1)
+            package_info.setdefault(key.strip(), value.strip())
+
+    return package_info
+
+
+def open_package_archive(stream, file_name):
+    '''
+    Open the package file as a stream of tar members (without decompressing it as a whole).
+    '''
+    if file_name.endswith('.zst'):
+        return tarfile.open(fileobj=zstandard.ZstdDecompressor().stream_reader(stream), mode='r|')
+
+    return tarfile.open(fileobj=stream, mode='r|*')
+
+
+def read_local_package_info(file_name):
+    '''
+    Stream the local package file until the .PKGINFO member is found and return its parsed content.
+    '''
+    with open(file_name, 'rb') as stream:
+        with open_package_archive(stream, file_name) as tar:
+            for member in tar:
+                if member.name == '.PKGINFO':
+                    return parse_package_info(tar.extractfile(member))
+
+    return {}
+
+
+def get_local_package_info(module, package, pacman):
+    '''
+    Retrieve name and version of the local package file.
+    '''
+    file_name = os.path.expanduser(package)
+    compression = is_local_package(file_name).group('compression')
+    name = None
+    version = None
+
+    if compression in streamable_compressions or (compression == 'zst' and HAS_ZSTANDARD):
+        try:
+            package_info = read_local_package_info(file_name)
+            name = package_info.get('pkgname')
+            version = package_info.get('pkgver')
+        except package_archive_errors:
+            pass
+
+    if name is None or version is None:
+        rc, stdout, _ = module.run_command([pacman, '-Q', '-p', file_name], check_rc=False)
+
+        if rc == 0 and len(stdout.split()) == 2:
+            name, version = stdout.split()
+
+    return (name, version)
+
+
+def get_aur_url(module, path):
+    '''
+    Retrieve URL of the resource available in the AUR.
+    '''
+    return '{}/{}'.format(module.params['aur_url'].rstrip('/'), path.lstrip('/'))
+
+
+def get_aur_package_info(module, package):
     '''
     Retrieve information about the AUR package.
     '''
-    url = 'https://aur.archlinux.org/rpc/?v=5&type=info&arg={}'.format(urllib.parse.quote(package))
-    request_result = open_url(url)
+    packages_info = package_index.query('aur', [package], module.params['aur_url'])
+
+    if packages_info is not None:
+        results = [packages_info[package]] if packages_info[package] else []
+        return {'resultcount': len(results), 'results': results}
+
+    url = get_aur_url(module, 'rpc/?v=5&type=info&arg={}'.format(urllib.parse.quote(package)))
+    request_result = instrumentation.request_url(url)
     return json.loads(request_result.read().decode('utf8'))
 
 
-def is_aur_package(package):
+def get_aur_packages_info(module, packages):
+    '''
+    Retrieve information about the AUR packages with using the batched requests.
+    '''
+    if not packages:
+        return {}
+
+    packages_info = package_index.query('aur', packages, module.params['aur_url'])
+
+    if packages_info is None:
+        packages_info = dict((package, None) for package in packages)
+
+        for index in range(0, len(packages), 100):
+            query = '&'.join('arg[]={}'.format(urllib.parse.quote(package)) for package in packages[index:index + 100])
+            request_result = instrumentation.request_url(get_aur_url(module, 'rpc/?v=5&type=info&{}'.format(query)))
+
+            for item in json.loads(request_result.read().decode('utf8'))['results']:
+                if item['Name'] in packages_info:
+                    packages_info[item['Name']] = item
+
+    return packages_info
+
+
+def is_aur_package(module, package):
     '''
     Determine if the package is available in the AUR.
     '''
-    info = get_aur_package_info(package)
+    info = get_aur_package_info(module, package)
     return info['resultcount'] > 0
 
 
@@ -415,6 +1351,11 @@ def is_official_package(module, package, pacman):
     '''
     Determine if the package is available in the official repositories.
     '''
+    official = package_index.query('official', [package])
+
+    if official is not None:
+        return official[package]
+
     ere = '^{}$'.format(re.escape(package))
     rc, _, _ = module.run_command([pacman, '-S', '-s', ere], check_rc=False)
     return rc == 0
@@ -424,6 +1365,11 @@ def extract_packages(module, package_group, pacman):
     '''
     Extract the package list from the official repository package group.
     '''
+    groups = package_index.query('groups', [package_group])
+
+    if groups is not None:
+        return groups[package_group]
+
     packages = []
     rc, stdout, _ = module.run_command([pacman, '-S', '-g', '-q', package_group], check_rc=False)
 
@@ -450,7 +1396,7 @@ def group_packages(module, names, pacman, result):
             if name:
                 if is_local_package(name):
                     local_packages.append(name)
-                elif is_aur_package(name) and not module.params['force']:
+                elif is_aur_package(module, name) and not module.params['force']:
                     aur_packages.append(name)
                 elif is_official_package(module, name, pacman):
                     extracted = extract_packages(module, name, pacman)
@@ -464,64 +1410,145 @@ def group_packages(module, names, pacman, result):
     return (packages, aur_packages, local_packages)
 
 
-def is_package_installed(module, package, pacman):
+def get_package_version(module, package, pacman):
     '''
-    Determine if the package is already installed.
+    Retrieve version of the package that has been already installed.
     '''
-    rc, _, _ = module.run_command([pacman, '-Q', package], check_rc=False)
-    return rc == 0
+    versions = package_index.query('installed', [package])
 
+    if versions is not None:
+        return versions[package]
 
-def get_package_version(module, package, pacman, remote_version=False):
-    '''
-    Retrieve version of the package that has been already installed or remote package version from the official
-    repositories.
-    '''
-    query_parameter = '-S' if remote_version else '-Q'
-    rc, stdout, _ = module.run_command([pacman, query_parameter, '-i', package], check_rc=False)
+    rc, stdout, _ = module.run_command([pacman, '-Q', '-i', package], check_rc=False)
     version = None
 
     if rc == 0:
-        version_line = 2 if remote_version else 1
-        line = stdout.split('\n')[version_line]
-        version = line.split(':')[-1].strip()
+        line = stdout.split('\n')[1]
+        version = line.split(':', 1)[-1].strip()
 
     return version
 
 
-def get_aur_package_version(package):
+def get_installed_package_versions(module, packages, pacman):
     '''
-    Retrieve version of the package from the AUR.
+    Retrieve versions of the installed packages from the single snapshot of the local package database. Names which
+    are not found there (eg. provided by other packages) are resolved by pacman with the single query for all of them.
     '''
-    info = get_aur_package_info(package)
-    version = None
+    versions = package_index.query('installed', packages) if packages else {}
 
-    if info['resultcount'] > 0:
-        version = info['results'][0]['Version'].split(':')[-1].strip()
+    if versions is None:
+        rc, stdout, _ = module.run_command([pacman, '-Q'], check_rc=False)
+        installed = dict(item.split()[:2] for item in stdout.split('\n') if len(item.split()) > 1) if rc == 0 else {}
+        versions = dict((package, installed.get(package)) for package in packages)
+        missing = [package for package in versions if versions[package] is None]
 
-    return version
+        if missing:
+            _, stdout, stderr = module.run_command([pacman, '-Q'] + missing, check_rc=False)
+            not_found = set(re.findall(r"package '(.+?)' was not found", stderr))
+            resolved = [package for package in missing if package not in not_found]
+            lines = [item.split() for item in stdout.split('\n') if len(item.split()) > 1]
 
+            if len(lines) == len(resolved):
+                for package, item in zip(resolved, lines):
+                    versions[package] = item[1]
+            else:
+                for package in missing:
+                    versions[package] = get_package_version(module, package, pacman)
 
-def get_package_details(module, package, pacman, aur_package=False):
+    return versions
+
+
+def parse_pacman_info_output(output):
     '''
-    Retrieve information if the package is already installed and has the latest version.
+    Parse the output of the 'I(pacman -Qi)' or 'I(pacman -Si)' command into the list of package fields.
     '''
-    installed = is_package_installed(module, package, pacman)
-    details = {
-        'package': package,
-        'installed': installed,
-        'latest': installed
-    }
+    packages_info = []
+    package_info = {}
+    key = None
+
+    for line in output.split('\n'):
+        if not line.strip():
+            package_info = {}
+            key = None
+        elif line[0].isspace() and key is not None:
+            package_info[key] = '{} {}'.format(package_info[key], line.strip())
+        elif ':' in line:
+            key, _, value = line.partition(':')
+            key = key.strip()
 
-    if module.params['state'] == 'latest' and installed:
-        version = get_package_version(module, package, pacman)
-        remote_version = get_aur_package_version(package) if aur_package \
-            else get_package_version(module, package, pacman, True)
+            if not package_info:
+                packages_info.append(package_info)
 
-        if remote_version is not None:
-            details['latest'] = version == remote_version
+            package_info[key] = value.strip()
 
-    return details
+    return packages_info
+
+
+def get_repository_package_versions(module, packages, pacman):
+    '''
+    Retrieve versions of the packages from the official repositories with using the single query.
+    '''
+    versions = package_index.query('repository', packages) if packages else {}
+
+    if versions is None:
+        versions = dict((package, None) for package in packages)
+        _, stdout, _ = module.run_command([pacman, '-S', '-i'] + packages, check_rc=False)
+
+        for package_info in parse_pacman_info_output(stdout):
+            if versions.get(package_info.get('Name'), '') is None:
+                versions[package_info['Name']] = package_info.get('Version')
+
+    return versions
+
+
+def get_packages_details(module, packages, pacman, aur_packages=False):
+    '''
+    Retrieve information if the packages are already installed and have the latest versions, with using the bulk
+    queries instead of checking every package separately.
+    '''
+    installed_versions = get_installed_package_versions(module, packages, pacman)
+    remote_versions = {}
+
+    if module.params['state'] == 'latest':
+        installed_packages = [package for package in packages if installed_versions[package] is not None]
+
+        if aur_packages:
+            for package, info in get_aur_packages_info(module, installed_packages).items():
+                remote_versions[package] = info['Version'].strip() if info else None
+        else:
+            remote_versions = get_repository_package_versions(module, installed_packages, pacman)
+
+    collected_details = []
+
+    for package in packages:
+        installed = installed_versions[package] is not None
+        remote_version = remote_versions.get(package)
+        collected_details.append({
+            'package': package,
+            'installed': installed,
+            'latest': installed_versions[package] == remote_version if installed and remote_version is not None
+            else installed
+        })
+
+    return collected_details
+
+
+def get_local_package_details(module, package, pacman, result):
+    '''
+    Retrieve information if the exact version of the local package file is already installed.
+    '''
+    name, version = get_local_package_info(module, package, pacman)
+
+    if name is None or version is None:
+        result['msg'] = 'could not read the package details from {}'.format(package)
+        module.fail_json(**result)
+
+    installed = get_package_version(module, name, pacman) == version
+    return {
+        'package': name,
+        'installed': installed,
+        'latest': installed
+    }
 
 
 def is_state_change_required(state, details):
@@ -547,13 +1574,17 @@ def return_name_result(module, number_of_changes, single_package, result, check_
     Prepare and return result for the name option.
     '''
     state = module.params['state']
+    action = 'downloaded' if module.params['download_only'] else state_equivalents[state]
     multiple_submsg = 'would be' if check_mode else 'have been'
     single_submsg = 'would be' if check_mode else 'has been'
 
     if number_of_changes > 0:
         result['changed'] = True
-        result['msg'] = '{} packages {} {}'.format(number_of_changes, multiple_submsg, state_equivalents[state]) \
-            if number_of_changes > 1 else 'package {} {}'.format(single_submsg, state_equivalents[state])
+        result['msg'] = '{} packages {} {}'.format(number_of_changes, multiple_submsg, action) \
+            if number_of_changes > 1 else 'package {} {}'.format(single_submsg, action)
+    elif module.params['download_only']:
+        result['msg'] = 'package does not need to be downloaded' if single_package \
+            else 'no packages need to be downloaded'
     else:
         result['msg'] = 'package is already {}'.format(state_equivalents[state]) if single_package \
             else 'all packages are already {}'.format(state_equivalents[state])
@@ -566,19 +1597,14 @@ def run_name_check_mode(module, packages, aur_packages, local_packages, pacman,
     Inform the user what would change if the module were run with the name option.
     '''
     state = module.params['state']
-    collected_details = []
+    collected_details = get_packages_details(module, packages, pacman)
     number_of_changes = 0
 
-    for package in packages:
-        collected_details.append(get_package_details(module, package, pacman))
-
     if state != 'absent':
-        for package in aur_packages:
-            collected_details.append(get_package_details(module, package, pacman, True))
+        collected_details.extend(get_packages_details(module, aur_packages, pacman, True))
 
         for package in local_packages:
-            package = re.sub(package_version_pattern, '', package.split('/')[-1])
-            collected_details.append(get_package_details(module, package, pacman))
+            collected_details.append(get_local_package_details(module, package, pacman, result))
 
     for details in collected_details:
         if is_state_change_required(state, details):
@@ -608,13 +1634,11 @@ def remove_packages(module, packages, pacman, result):
     '''
     number_of_changes = 0
 
-    for package in packages:
-        package_details = get_package_details(module, package, pacman)
-
+    for package_details in get_packages_details(module, packages, pacman):
         if package_details['installed']:
             cmd = prepare_remove_package_command(module, pacman)
             cmd.append(package_details['package'])
-            rc, _, stderr = module.run_command(cmd, check_rc=False)
+            rc, _, stderr = run_transaction_command(module, cmd, result)
 
             if rc != 0:
                 result['msg'] = 'failed to remove {}: {}'.format(package_details['package'], stderr)
@@ -631,7 +1655,7 @@ def run_install_packages_command(module, cmd, packages, result):
     '''
     cmd.extend(split_extra_args(module.params['extra_args']))
     cmd.extend(packages)
-    rc, _, stderr = module.run_command(cmd, check_rc=False)
+    rc, _, stderr = run_transaction_command(module, cmd, result)
 
     if rc != 0:
         result['msg'] = 'failed to install {}: {}'.format(' '.join(packages), stderr)
@@ -642,13 +1666,17 @@ def install_packages_with_pacman(module, packages, pacman, result, local_resourc
     '''
     Install the desired package(s) with using pacman.
     '''
-    packages_to_install = []
+    state = module.params['state']
 
-    for package in packages:
-        package_name = re.sub(package_version_pattern, '', package.split('/')[-1]) if local_resources else package
+    packages_to_install = []
 
-        if is_state_change_required(module.params['state'], get_package_details(module, package_name, pacman)):
-            packages_to_install.append(package)
+    if local_resources:
+        for package in packages:
+            if is_state_change_required(state, get_local_package_details(module, package, pacman, result)):
+                packages_to_install.append(package)
+    else:
+        packages_to_install = [item['package'] for item in get_packages_details(module, packages, pacman)
+                               if is_state_change_required(state, item)]
 
     if packages_to_install:
         cmd = [pacman, '-U'] if local_resources else [pacman, '-S']
@@ -662,89 +1690,272 @@ def install_packages_with_wrapper(module, packages, aur_packages, wrapper, pacma
     '''
     Install the desired package(s) with using the pacman's wrapper.
     '''
-    params = module.params
-    packages_to_install = []
-
-    for package in packages:
-        if is_state_change_required(params['state'], get_package_details(module, package, pacman)):
-            packages_to_install.append(package)
-
-    for package in aur_packages:
-        if is_state_change_required(params['state'], get_package_details(module, package, pacman, True)):
-            packages_to_install.append(package)
+    state = module.params['state']
+    collected_details = get_packages_details(module, packages, pacman)
+    collected_details.extend(get_packages_details(module, aur_packages, pacman, True))
+    packages_to_install = [item['package'] for item in collected_details if is_state_change_required(state, item)]
 
     if packages_to_install:
-        run_install_packages_command(module, get_pacman_wrapper_command(wrapper), packages_to_install, result)
+        cmd = get_pacman_wrapper_command(wrapper, prefiltered=True)
+        run_install_packages_command(module, cmd, packages_to_install, result)
 
     return len(packages_to_install)
 
 
-def download_aur_package(file_name, url_path):
+def download_aur_package(module, file_name, url_path):
     '''
     Download package from the AUR.
     '''
-    file_url = open_url('https://aur.archlinux.org/{}'.format(url_path))
+    file_url = instrumentation.request_url(get_aur_url(module, url_path))
 
     with open(file_name, 'wb') as stream:
         stream.write(file_url.read())
 
 
-def extract_tar_file(file_name):
+def extract_tar_file(file_name, path):
     '''
     Extract package from the tar file.
     '''
     tar = tarfile.open(file_name)
-    tar.extractall()
+    tar.extractall(path)
     tar.close()
 
 
-def prepare_aur_package_install_command(module):
+def get_aur_cache_directory(module):
+    '''
+    Retrieve the directory where AUR packages are downloaded and built.
+    '''
+    cache_directory = module.params['aur_cache_dir']
+
+    if not os.path.isdir(cache_directory):
+        os.makedirs(cache_directory)
+
+    return cache_directory
+
+
+def get_aur_build_version(build_directory):
+    '''
+    Retrieve version of the AUR package snapshot already extracted into the build directory.
+    '''
+    fields = {}
+    srcinfo_file = os.path.join(build_directory, '.SRCINFO')
+
+    if not os.path.isfile(srcinfo_file):
+        return None
+
+    with open(srcinfo_file) as stream:
+        for line in stream:
+            key, _, value = line.partition('=')
+
+            if key.strip() in ('epoch', 'pkgver', 'pkgrel'):
+                fields.setdefault(key.strip(), value.strip())
+
+    if 'pkgver' not in fields or 'pkgrel' not in fields:
+        return None
+
+    version = '{}-{}'.format(fields['pkgver'], fields['pkgrel'])
+    return '{}:{}'.format(fields['epoch'], version) if fields.get('epoch', '0') != '0' else version
+
+
+def prepare_aur_build_directory(module, cache_directory, package_info):
+    '''
+    Download and extract the AUR package snapshot (unless the same version is already extracted), then return its
+    build directory.
+    '''
+    package_base = package_info['PackageBase'].strip()
+    build_directory = os.path.join(cache_directory, package_base)
+
+    if get_aur_build_version(build_directory) == package_info['Version'].strip():
+        return build_directory
+
+    tar_file_name = os.path.join(cache_directory, '{}.tar.gz'.format(package_base))
+
+    with instrumentation.phase('build'):
+        download_aur_package(module, tar_file_name, package_info['URLPath'].strip())
+        extract_tar_file(tar_file_name, cache_directory)
+        os.remove(tar_file_name)
+
+    return build_directory
+
+
+def get_aur_package_files(module, build_directory):
+    '''
+    Retrieve paths of the package files which are built from the AUR package base.
     '''
-    Prepare and return the package install command with using makepkg.
+    cmd = [module.get_bin_path('makepkg'), '--packagelist']
+    rc, stdout, _ = module.run_command(cmd, cwd=build_directory, check_rc=False)
+    return [item.strip() for item in stdout.split('\n') if item.strip()] if rc == 0 else []
+
+
+def is_aur_package_built(module, build_directory):
+    '''
+    Determine if all package files of the AUR package base have been already built.
+    '''
+    package_files = get_aur_package_files(module, build_directory)
+    return bool(package_files) and all(os.path.isfile(item) for item in package_files)
+
+
+def prepare_aur_package_build_command(module):
     '''
-    cmd = [module.get_bin_path('makepkg'), '-s', '-i', '--needed', '--noconfirm', '--noprogressbar']
+    Prepare and return the package build command with using makepkg, which removes the src/ and pkg/ work trees
+    after a successful build.
+    '''
+    cmd = [module.get_bin_path('makepkg'), '-s', '-c', '--noconfirm', '--noprogressbar']
     cmd.extend(split_extra_args(module.params['extra_args']))
     return cmd
 
 
+def get_aur_packages_to_install(module, packages, pacman, result):
+    '''
+    Retrieve the AUR package details of the package(s) which state needs to be changed.
+    '''
+    state = module.params['state']
+    collected_details = get_packages_details(module, packages, pacman, True)
+    packages_to_install = [item['package'] for item in collected_details if is_state_change_required(state, item)]
+    packages_info = get_aur_packages_info(module, packages_to_install)
+
+    for package in packages_to_install:
+        if packages_info[package] is None:
+            result['msg'] = 'failed to install {}: could not retrieve the package details'.format(package)
+            module.fail_json(**result)
+
+    return [packages_info[package] for package in packages_to_install]
+
+
+def group_aur_packages_by_base(packages_info):
+    '''
+    Group the AUR package details by their package base.
+    '''
+    package_bases = {}
+
+    for package_info in packages_info:
+        package_bases.setdefault(package_info['PackageBase'].strip(), []).append(package_info)
+
+    return package_bases
+
+
+def download_aur_package_sources(module, build_directory, result):
+    '''
+    Download and verify the sources of the AUR package base with using makepkg, without installing any dependencies.
+    '''
+    cmd = [module.get_bin_path('makepkg'), '--verifysource', '--noconfirm', '--noprogressbar']
+    cmd.extend(split_extra_args(module.params['extra_args']))
+
+    with instrumentation.phase('build'):
+        rc, _, stderr = module.run_command(cmd, cwd=build_directory, check_rc=False)
+
+    if rc != 0:
+        result['msg'] = 'failed to download sources of {}: {}'.format(os.path.basename(build_directory), stderr)
+        module.fail_json(**result)
+
+
+def build_aur_package_base(module, build_directory, result):
+    '''
+    Build the AUR package base with using makepkg, unless it has been already built.
+    '''
+    if is_aur_package_built(module, build_directory):
+        return
+
+    cmd = prepare_aur_package_build_command(module)
+    rc, _, stderr = run_transaction_command(module, cmd, result, 'build', cwd=build_directory)
+
+    if rc != 0:
+        result['msg'] = 'failed to build {}: {}'.format(os.path.basename(build_directory), stderr)
+        module.fail_json(**result)
+
+
 def install_aur_packages_with_makepkg(module, packages, pacman, result):
     '''
-    Install the desired AUR package(s) with using makepkg.
+    Install the desired AUR package(s) with using makepkg, building every package base only once.
     '''
-    params = module.params
-    cmd = prepare_aur_package_install_command(module)
-    current_directory = os.getcwd()
+    cache_directory = get_aur_cache_directory(module)
+    install_cmd = [module.get_bin_path('sudo', True), '-n', pacman, '-U', '--needed', '--noconfirm', '--noprogressbar']
+    package_bases = group_aur_packages_by_base(get_aur_packages_to_install(module, packages, pacman, result))
     number_of_changes = 0
 
-    for package in packages:
-        if is_state_change_required(params['state'], get_package_details(module, package, pacman, True)):
-            info = get_aur_package_info(package)
+    for packages_info in package_bases.values():
+        names = set(item['Name'].strip() for item in packages_info)
+        build_directory = prepare_aur_build_directory(module, cache_directory, packages_info[0])
+        build_aur_package_base(module, build_directory, result)
+        package_files = []
 
-            if info['resultcount'] < 1:
-                result['msg'] = 'failed to install {}: could not retrieve the package details'.format(package)
-                module.fail_json(**result)
+        for package_file in get_aur_package_files(module, build_directory):
+            match = re.match(cached_package_pattern, os.path.basename(package_file))
 
-            package_name = info['results'][0]['Name'].strip()
-            url_path = info['results'][0]['URLPath'].strip()
-            tar_file_name = '{}.tar.gz'.format(package_name)
+            if match and match.group('name') in names:
+                package_files.append(package_file)
 
-            with tempfile.TemporaryDirectory() as temporary_directory:
-                os.chdir(temporary_directory)
-                download_aur_package(tar_file_name, url_path)
-                extract_tar_file(tar_file_name)
-                os.chdir(package_name)
-                rc, _, stderr = module.run_command(cmd, check_rc=True)
+        if len(package_files) < len(names):
+            result['msg'] = 'failed to install {}: could not find the built package files'.format(
+                ' '.join(sorted(names)))
+            module.fail_json(**result)
 
-                if rc != 0:
-                    result['msg'] = 'failed to install {}: {}'.format(package, stderr)
-                    module.fail_json(**result)
+        rc, _, stderr = run_transaction_command(module, install_cmd + package_files, result)
 
-                number_of_changes += 1
+        if rc != 0:
+            result['msg'] = 'failed to install {}: {}'.format(' '.join(sorted(names)), stderr)
+            module.fail_json(**result)
+
+        number_of_changes += len(names)
 
-    os.chdir(current_directory)
     return number_of_changes
 
 
+def download_packages(module, packages, aur_packages, local_packages, pacman, result):
+    '''
+    Download the desired package(s) into the local caches without installing them. Local package files are already
+    available, and AUR packages (their snapshots and sources) are prefetched only when they would be installed with
+    using makepkg.
+    '''
+    params = module.params
+    handler = get_handler(module, pacman)
+    packages_to_download = [item['package'] for item in get_packages_details(module, packages, pacman)
+                            if is_state_change_required(params['state'], item)]
+    aur_packages_info = []
+
+    if aur_packages and handler != pacman:
+        module.warn('aur packages are not downloaded in advance when the pacman\'s wrapper is installed')
+    elif aur_packages:
+        if get_current_user_name(module) == 'root':
+            result['msg'] = 'could not download aur packages as a root'
+            module.fail_json(**result)
+
+        aur_packages_info = get_aur_packages_to_install(module, aur_packages, pacman, result)
+
+    if packages_to_download and handler == pacman and get_current_user_name(module) != 'root':
+        result['msg'] = 'could not download packages from the official repositories as a non-root user when no ' \
+            'pacman\'s wrapper is installed'
+        module.fail_json(**result)
+
+    # AUR snapshots are fetched in the background while the official packages are being downloaded.
+    cache_directory = get_aur_cache_directory(module) if aur_packages_info else None
+    package_bases = group_aur_packages_by_base(aur_packages_info)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = dict((package_base, executor.submit(prepare_aur_build_directory, module, cache_directory, items[0]))
+                       for package_base, items in package_bases.items())
+
+        if packages_to_download:
+            cmd = [handler, '-S', '-w', '--needed', '--noconfirm', '--noprogressbar']
+            run_install_packages_command(module, cmd, packages_to_download, result)
+
+        build_directories = []
+
+        for package_base, future in futures.items():
+            try:
+                build_directories.append(future.result())
+            except Exception as e:
+                result['msg'] = 'failed to download {}: {}'.format(package_base, e)
+                module.fail_json(**result)
+
+    for build_directory in build_directories:
+        download_aur_package_sources(module, build_directory, result)
+
+    result['handler'] = handler if packages_to_download or not aur_packages_info else module.get_bin_path('makepkg')
+    return_name_result(module, len(packages_to_download) + len(aur_packages_info),
+                       len(packages) + len(aur_packages) + len(local_packages) == 1, result)
+
+
 def install_packages_with_aur_support(module, packages, aur_packages, pacman, result):
     '''
     Install the desired package(s) with the AUR support.
@@ -794,6 +2005,10 @@ def install_packages(module, packages, aur_packages, local_packages, pacman, res
             number_of_changes += install_packages_with_pacman(module, local_packages, pacman, result, True)
 
     result['handler'] = handler
+
+    if number_of_changes > 0:
+        prune_package_caches(module, result)
+
     return_name_result(module, number_of_changes, number_of_all_packages == 1, result)
 
 
@@ -804,7 +2019,15 @@ def run_module():
         upgrade=dict(type='bool', default=False),
         update_cache=dict(type='bool', default=False, aliases=['update-cache']),
         force=dict(type='bool', default=False),
-        extra_args=dict(type='str', default='')
+        extra_args=dict(type='str', default=''),
+        download_only=dict(type='bool', default=False),
+        aur_cache_dir=dict(type='path', default='~/.cache/pacaur'),
+        cache_retention=dict(type='int'),
+        lock_timeout=dict(type='int', default=300),
+        aur_url=dict(type='str', default='https://aur.archlinux.org'),
+        index_helper=dict(type='path'),
+        metrics=dict(type='bool', default=False),
+        trace_file=dict(type='path')
     )
 
     result = dict(
@@ -820,9 +2043,32 @@ def run_module():
         supports_check_mode=True
     )
 
-    pacman = module.get_bin_path('pacman', True)
+    # The package details are parsed from the pacman's output, so it cannot be localized.
+    module.run_command_environ_update = dict(LANG='C', LC_ALL='C', LC_MESSAGES='C', LC_CTYPE='C')
+
     params = module.params
 
+    if params['metrics'] or params['trace_file']:
+        instrumentation.install(module)
+
+    pacman = module.get_bin_path('pacman', True)
+    index_helper_error = package_index.connect(params['index_helper'])
+
+    if index_helper_error:
+        module.warn('{}, resolving the package details without it'.format(index_helper_error))
+
+    if params['cache_retention'] is not None and params['cache_retention'] < 0:
+        result['msg'] = 'cache_retention must be a non-negative number'
+        module.fail_json(**result)
+
+    if params['lock_timeout'] < 0:
+        result['msg'] = 'lock_timeout must be a non-negative number'
+        module.fail_json(**result)
+
+    if params['download_only'] and params['name'] and params['state'] == 'absent':
+        result['msg'] = 'could not download packages with the absent state'
+        module.fail_json(**result)
+
     if params['update_cache']:
         if not module.check_mode:
             refresh_package_databases(module, pacman, result)
@@ -839,7 +2085,8 @@ def run_module():
             upgrade(module, pacman, result)
 
     if params['name']:
-        packages, aur_packages, local_packages = group_packages(module, params['name'], pacman, result)
+        with instrumentation.phase('classification'):
+            packages, aur_packages, local_packages = group_packages(module, params['name'], pacman, result)
 
         if aur_packages and local_packages:
             result['msg'] = 'could not install aur packages mixed with local packages'
@@ -850,14 +2097,33 @@ def run_module():
 
         if params['state'] == 'absent':
             remove_packages(module, packages, pacman, result)
+        elif params['download_only']:
+            download_packages(module, packages, aur_packages, local_packages, pacman, result)
         else:
             install_packages(module, packages, aur_packages, local_packages, pacman, result)
     else:
         module.exit_json(**result)
 
 
+def run_index_helper(args):
+    parser = argparse.ArgumentParser(prog='pacaur.py', description='Package index helper for the pacaur module.')
+    parser.add_argument('--serve-index', metavar='SOCKET', required=True, help='path to the Unix socket')
+    parser.add_argument('--pacman', default='pacman', help='path to the pacman executable')
+    parser.add_argument('--db-path', default='/var/lib/pacman/', help='path to the package databases')
+    parser.add_argument('--aur-url', default='https://aur.archlinux.org', help='base URL of the AUR')
+    parser.add_argument('--aur-ttl', type=int, default=300, help='lifetime of the AUR package details in seconds')
+    parser.add_argument('--idle-timeout', type=int, default=0, help='exit after being idle for the given seconds')
+    parser.add_argument('--socket-group', help='group allowed to connect to the socket (besides its owner)')
+    options = parser.parse_args(args)
+    serve_package_index(options.serve_index, options.pacman, options.db_path, options.aur_url, options.aur_ttl,
+                        options.idle_timeout, options.socket_group)
+
+
 def main():
-    run_module()
+    if '--serve-index' in sys.argv[1:]:
+        run_index_helper(sys.argv[1:])
+    else:
+        run_module()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,101 @@
+'''
+Local HTTP server imitating the AUR RPC and snapshot endpoints for the benchmarks.
+'''
+
+import io
+import json
+import tarfile
+import threading
+import urllib.parse
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class AurRequestHandler(BaseHTTPRequestHandler):
+    '''
+    Answer the RPC info requests and serve the package snapshots generated on the fly.
+    '''
+
+    def log_message(self, *args):
+        pass
+
+    def send_content(self, content, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        packages = self.server.packages
+
+        if url.path.rstrip('/') == '/rpc':
+            query = urllib.parse.parse_qs(url.query)
+            names = query.get('arg', []) + query.get('arg[]', [])
+            results = [self.server.get_package_info(name) for name in names if name in packages]
+            self.server.count('rpc')
+            self.send_content(json.dumps({'resultcount': len(results), 'results': results}).encode('utf8'),
+                              'application/json')
+        elif url.path.startswith('/cgit/aur.git/snapshot/') and url.path.endswith('.tar.gz'):
+            package_base = url.path.split('/')[-1][:-len('.tar.gz')]
+            self.server.count('snapshot')
+            self.send_content(self.server.get_snapshot(package_base), 'application/x-gzip')
+        else:
+            self.send_error(404)
+
+
+class AurServer(ThreadingHTTPServer):
+    '''
+    AUR stand-in serving the given packages, counting the received requests.
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, packages):
+        super().__init__(('127.0.0.1', 0), AurRequestHandler)
+        self.packages = packages
+        self.requests = {'rpc': 0, 'snapshot': 0}
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+    def count(self, endpoint):
+        with self.lock:
+            self.requests[endpoint] += 1
+
+    def get_package_info(self, name):
+        package_base, version = self.packages[name]
+        return {
+            'Name': name,
+            'PackageBase': package_base,
+            'Version': version,
+            'URLPath': '/cgit/aur.git/snapshot/{}.tar.gz'.format(package_base)
+        }
+
+    def get_snapshot(self, package_base):
+        names = sorted(name for name, (base, _) in self.packages.items() if base == package_base)
+        pkgver, pkgrel = self.packages[names[0]][1].rsplit('-', 1)
+        srcinfo = 'pkgbase = {}\n\tpkgver = {}\n\tpkgrel = {}\n\n'.format(package_base, pkgver, pkgrel)
+        srcinfo += ''.join('pkgname = {}\n\n'.format(name) for name in names)
+        stream = io.BytesIO()
+
+        with tarfile.open(fileobj=stream, mode='w:gz') as tar:
+            for file_name, content in (('PKGBUILD', '# fake\n'), ('.SRCINFO', srcinfo)):
+                data = content.encode('utf8')
+                member = tarfile.TarInfo('{}/{}'.format(package_base, file_name))
+                member.size = len(data)
+                tar.addfile(member, io.BytesIO(data))
+
+        return stream.getvalue()
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,180 @@
+'''
+Benchmarks running the module against the scripted pacman/makepkg/yay stand-ins and the local AUR server, asserting
+the regression budgets on the process spawns and the HTTP requests reported by the metrics output.
+'''
+
+import json
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+from aur_server import AurServer
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+MODULE = os.path.join(os.path.dirname(os.path.dirname(BENCH_DIR)), 'pacaur.py')
+FAKEBIN = os.path.join(BENCH_DIR, 'fakebin')
+WRAPPERBIN = os.path.join(BENCH_DIR, 'wrapperbin')
+
+# The largest size takes several minutes, so it runs only on demand.
+SIZES = [1, 10, 100] + ([1000] if os.environ.get('PACAUR_BENCH_LARGE') else [])
+
+# The package origins: official packages installed by root with pacman, AUR packages built with makepkg (one or two
+# packages per package base) and a mix of both installed by a non-root user with the yay wrapper.
+ORIGINS = {
+    'repo': {'user': 'root', 'modes': ['present', 'latest', 'absent', 'check', 'download']},
+    'aur': {'user': 'builder', 'modes': ['present', 'latest', 'check', 'download']},
+    'split': {'user': 'builder', 'modes': ['present', 'latest', 'download']},
+    'wrapper': {'user': 'builder', 'modes': ['present', 'latest', 'check']},
+}
+
+# Budgets are "fixed + per_package * size" limits on the spawns and the requests of a single run. Classifying every
+# name costs one AUR request plus the pacman search and group lookup, the AUR installs are planned with bulk queries
+# and every built AUR package base costs the snapshot download, two makepkg calls and the pacman -U transaction.
+BUDGETS = {
+    ('repo', 'present'): {'commands': (5, 2), 'requests': (0, 1)},
+    ('repo', 'latest'): {'commands': (6, 2), 'requests': (0, 1)},
+    ('repo', 'absent'): {'commands': (2, 1), 'requests': (0, 0)},
+    ('repo', 'check'): {'commands': (2, 2), 'requests': (0, 1)},
+    ('repo', 'download'): {'commands': (6, 2), 'requests': (0, 1)},
+    ('aur', 'present'): {'commands': (7, 2), 'requests': (1, 2)},
+    ('aur', 'latest'): {'commands': (5, 4), 'requests': (2, 2)},
+    ('aur', 'check'): {'commands': (2, 0), 'requests': (0, 1)},
+    ('aur', 'download'): {'commands': (4, 1), 'requests': (1, 2)},
+    ('split', 'present'): {'commands': (7, 2), 'requests': (1, 2)},
+    ('split', 'latest'): {'commands': (7, 2), 'requests': (2, 2)},
+    ('split', 'download'): {'commands': (4, 1), 'requests': (1, 2)},
+    ('wrapper', 'present'): {'commands': (7, 1), 'requests': (0, 1)},
+    ('wrapper', 'latest'): {'commands': (8, 1), 'requests': (0, 1)},
+    ('wrapper', 'check'): {'commands': (3, 1), 'requests': (0, 1)},
+}
+
+
+def package_names(origin, size):
+    return ['{}pkg{:04d}'.format(origin, index) for index in range(size)]
+
+
+def get_package_sources(origin, size):
+    '''
+    Split the package names into the official and the AUR ones, mapping the AUR ones to their package bases.
+    '''
+    names = package_names(origin, size)
+
+    if origin == 'repo':
+        return (names, {})
+
+    if origin == 'wrapper':
+        return (names[1::2], dict((name, name) for name in names[::2]))
+
+    if origin == 'split':
+        return ([], dict((name, '{}base{:04d}'.format(origin, index // 2)) for index, name in enumerate(names)))
+
+    return ([], dict((name, name) for name in names))
+
+
+def prepare_root(tmp_path, server, origin, mode, size):
+    root = tmp_path / 'root'
+    (root / 'db').mkdir(parents=True)
+    (root / 'cache').mkdir()
+    names = package_names(origin, size)
+    official, aur = get_package_sources(origin, size)
+
+    (root / 'repo').write_text(''.join('{} 2.0-1\n'.format(name) for name in official))
+    (root / 'aur').write_text(''.join('{} 2.0-1\n'.format(name) for name in sorted(aur)))
+    server.packages.update((name, (package_base, '2.0-1')) for name, package_base in aur.items())
+
+    # Every other package is already installed in an older version, so every mode has work to do.
+    installed = names[1::2] if mode != 'absent' else names
+    (root / 'installed').write_text(''.join('{} 1.0-1\n'.format(name) for name in installed))
+
+    return root
+
+
+def run_benchmark(tmp_path, server, origin, mode, size):
+    root = prepare_root(tmp_path, server, origin, mode, size)
+    arguments = {
+        'name': package_names(origin, size),
+        'state': {'check': 'present', 'download': 'present'}.get(mode, mode),
+        'download_only': mode == 'download',
+        'aur_url': server.url,
+        'aur_cache_dir': str(tmp_path / 'aur'),
+        'metrics': True,
+        '_ansible_check_mode': mode == 'check'
+    }
+    arguments_file = tmp_path / 'args.json'
+    arguments_file.write_text(json.dumps({'ANSIBLE_MODULE_ARGS': arguments}))
+
+    env = dict(os.environ)
+    env['PATH'] = os.pathsep.join([FAKEBIN] + ([WRAPPERBIN] if origin == 'wrapper' else []) + [env.get('PATH', '')])
+    env['FAKE_PACMAN_ROOT'] = str(root)
+    env['FAKE_USER'] = ORIGINS[origin]['user']
+    env['HOME'] = str(tmp_path)
+
+    start = time.monotonic()
+    process = subprocess.run([sys.executable, MODULE, str(arguments_file)], env=env, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, universal_newlines=True, timeout=1800)
+    wall_time = time.monotonic() - start
+
+    assert process.stdout, process.stderr
+    result = json.loads(process.stdout)
+    assert not result.get('failed'), result
+
+    return result, wall_time, root
+
+
+@pytest.fixture
+def aur_server():
+    with AurServer({}) as server:
+        yield server
+
+
+@pytest.mark.parametrize('size', SIZES)
+@pytest.mark.parametrize('origin,mode', [(origin, mode) for origin in ORIGINS for mode in ORIGINS[origin]['modes']])
+def test_budget(tmp_path, aur_server, origin, mode, size):
+    result, wall_time, root = run_benchmark(tmp_path, aur_server, origin, mode, size)
+    metrics = result['metrics']
+    commands = metrics['commands']
+    requests = metrics['requests']
+
+    sys.stdout.write('\n{:7} {:7} {:5} wall={:.2f}s duration={:.2f}s commands={} requests={}'.format(
+        origin, mode, size, wall_time, metrics['duration'], commands, requests))
+
+    assert requests == sum(aur_server.requests.values())
+
+    for key, count in (('commands', commands), ('requests', requests)):
+        fixed, per_package = BUDGETS[(origin, mode)][key]
+        assert count <= fixed + per_package * size, '{} over budget: {}'.format(key, metrics['classes'])
+
+    if origin == 'wrapper' and mode != 'check':
+        # The versions have been already compared, so yay must not look for the devel packages updates on its own.
+        wrapper_calls = (root / 'yay.log').read_text().splitlines()
+        assert wrapper_calls and all('--nodevel' in line.split() for line in wrapper_calls)
+
+    names = package_names(origin, size)
+    installed = dict(line.split() for line in (root / 'installed').read_text().splitlines())
+    assert result['changed']
+
+    if mode == 'download':
+        # Neither the build dependencies nor any packages are installed (or removed) by a download-only run.
+        assert not [item for item in metrics['classes'] if item.startswith('sudo') or item.startswith('makepkg -s')]
+
+    if origin in ('aur', 'split') and mode != 'check':
+        # Only the snapshots, the sources and the built packages are kept, the makepkg work trees are removed.
+        for build_directory in (tmp_path / 'aur').iterdir():
+            assert not (build_directory / 'src').exists() and not (build_directory / 'pkg').exists()
+            assert (build_directory / 'sources.tar.gz').exists() == (mode == 'download')
+            assert bool(list(build_directory.glob('*.pkg.tar.zst'))) != (mode == 'download')
+
+    if mode in ('check', 'download'):
+        assert installed == dict((name, '1.0-1') for name in names[1::2])
+    elif mode == 'absent':
+        assert not installed
+    else:
+        expected = dict((name, '2.0-1') for name in names)
+
+        if mode == 'present':
+            expected.update((name, '1.0-1') for name in names[1::2])
+
+        assert installed == expected
@@ -0,0 +1,479 @@
+'''
+Unit tests for the pure helpers of the pacaur module.
+'''
+
+import io
+import os
+import socket
+import socketserver
+import tarfile
+import threading
+import time
+
+import pytest
+
+import pacaur
+
+from bench.aur_server import AurServer
+
+
+@pytest.mark.parametrize('version_a,version_b,expected', [
+    ('1.0', '1.0', 0),
+    ('1.0-1', '1.0-2', -1),
+    ('1.0-1', '1.0', 0),
+    ('1.0', '1.0.1', -1),
+    ('1.10', '1.9', 1),
+    ('1.0rc', '1.0', -1),
+    ('1.0a', '1.0b', -1),
+    ('1.0', '1.0.a', -1),
+    ('1.0.a', '1.0.1', -1),
+    ('1.0_1', '1.0.1', 0),
+    ('1:1.0-1', '2.0-1', 1),
+    ('0:2.0-1', '2.0-1', 0),
+    (':2.0-1', '2.0-1', 0),
+    ('1:1.0', '2:0.1', -1),
+    ('2.0-1.1', '2.0-1', 1),
+    ('20230101', '1.0', 1),
+])
+def test_compare_package_versions(version_a, version_b, expected):
+    assert pacaur.compare_package_versions(version_a, version_b) == expected
+    assert pacaur.compare_package_versions(version_b, version_a) == -expected
+
+
+@pytest.mark.parametrize('version,expected', [
+    ('1.0', ('0', '1.0', None)),
+    ('1.0-2', ('0', '1.0', '2')),
+    ('3:1.0-2', ('3', '1.0', '2')),
+    ('1:2:3-4', ('1', '2:3', '4')),
+])
+def test_split_package_version(version, expected):
+    assert pacaur.split_package_version(version) == expected
+
+def test_parse_package_info():
+    stream = io.BytesIO(b'# Generated by makepkg\npkgname = foo-2fa\npkgver = 1:2.0-1\n'
+                        b'depend = bar\ndepend = baz\nbroken line\n')
+
+    assert pacaur.parse_package_info(stream) == {'pkgname': 'foo-2fa', 'pkgver': '1:2.0-1', 'depend': 'bar'}
+
+
+def build_package_file(path, compression):
+    package_info = b'pkgname = foo-2fa\npkgver = 1:2.0-1\n'
+    stream = io.BytesIO()
+
+    with tarfile.open(fileobj=stream, mode='w') as tar:
+        for name, content in (('.BUILDINFO', b'format = 2\n'), ('.PKGINFO', package_info), ('usr/bin/foo', b'')):
+            member = tarfile.TarInfo(name)
+            member.size = len(content)
+            tar.addfile(member, io.BytesIO(content))
+
+    content = stream.getvalue()
+
+    if compression == 'zst':
+        zstandard = pytest.importorskip('zstandard')
+        content = zstandard.ZstdCompressor().compress(content)
+    elif compression:
+        module = __import__({'gz': 'gzip', 'bz2': 'bz2', 'xz': 'lzma'}[compression])
+        content = module.compress(content)
+
+    file_name = path / 'foo-2fa-1:2.0-1-x86_64.pkg.tar{}'.format('.' + compression if compression else '')
+    file_name.write_bytes(content)
+    return str(file_name)
+
+
+@pytest.mark.parametrize('compression', [None, 'gz', 'bz2', 'xz', 'zst'])
+def test_read_local_package_info(tmp_path, compression):
+    file_name = build_package_file(tmp_path, compression)
+
+    assert pacaur.is_local_package(file_name).group('compression') == compression
+    assert pacaur.read_local_package_info(file_name) == {'pkgname': 'foo-2fa', 'pkgver': '1:2.0-1'}
+
+
+def test_read_local_package_info_without_package_info(tmp_path):
+    file_name = tmp_path / 'foo-1.0-1-any.pkg.tar'
+
+    with tarfile.open(str(file_name), mode='w') as tar:
+        tar.addfile(tarfile.TarInfo('usr/bin/foo'), io.BytesIO(b''))
+
+    assert pacaur.read_local_package_info(str(file_name)) == {}
+
+
+def create_cached_files(directory, names):
+    for index, name in enumerate(names):
+        (directory / name).write_bytes(b'x' * (index + 1))
+
+    return dict((name, index + 1) for index, name in enumerate(names))
+
+
+@pytest.mark.parametrize('retention,kept', [
+    (2, ['foo-1:0.5-1-x86_64.pkg.tar.zst', 'foo-2.0-1-x86_64.pkg.tar.zst', 'foo-1.0-1-any.pkg.tar.zst',
+         'bar-1.0-1-x86_64.pkg.tar.xz', 'bar-1.0-1-x86_64.pkg.tar.xz.sig']),
+    (1, ['foo-1:0.5-1-x86_64.pkg.tar.zst', 'foo-1.0-1-any.pkg.tar.zst', 'bar-1.0-1-x86_64.pkg.tar.xz',
+         'bar-1.0-1-x86_64.pkg.tar.xz.sig']),
+    (0, []),
+])
+def test_prune_package_cache(tmp_path, retention, kept):
+    sizes = create_cached_files(tmp_path, [
+        'foo-1.0-1-x86_64.pkg.tar.zst', 'foo-1.0-1-x86_64.pkg.tar.zst.sig', 'foo-2.0-1-x86_64.pkg.tar.zst',
+        'foo-1:0.5-1-x86_64.pkg.tar.zst', 'foo-1.0-1-any.pkg.tar.zst', 'bar-1.0-1-x86_64.pkg.tar.xz',
+        'bar-1.0-1-x86_64.pkg.tar.xz.sig', 'notes.txt'])
+    kept = kept + ['notes.txt']
+
+    reclaimed_bytes = pacaur.prune_package_cache(str(tmp_path), retention)
+
+    assert sorted(item.name for item in tmp_path.iterdir()) == sorted(kept)
+    assert reclaimed_bytes == sum(size for name, size in sizes.items() if name not in kept)
+
+
+class FakeModule(object):
+    '''
+    AnsibleModule stand-in returning the scripted command results.
+    '''
+
+    def __init__(self, params=None, results=None):
+        self.params = dict(params or {})
+        self.results = list(results or [])
+        self.commands = []
+        self.warnings = []
+
+    def get_bin_path(self, name, required=False):
+        return None
+
+    def run_command(self, cmd, check_rc=False, **kwargs):
+        self.commands.append(cmd)
+        return self.results.pop(0) if self.results else (0, '', '')
+
+    def warn(self, warning):
+        self.warnings.append(warning)
+
+
+class FakeClock(object):
+    '''
+    Replacement of the time module, advancing the monotonic time only by the slept durations.
+    '''
+
+    def __init__(self, on_sleep=None):
+        self.now = 1000.0
+        self.sleeps = []
+        self.on_sleep = on_sleep
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, duration):
+        assert duration >= 0
+        self.sleeps.append(duration)
+        self.now += duration
+
+        if self.on_sleep:
+            self.on_sleep(self)
+
+
+@pytest.fixture
+def lock_file(tmp_path, monkeypatch):
+    path = tmp_path / 'db.lck'
+    path.write_text('')
+    monkeypatch.setattr(pacaur, 'get_pacman_lock_file', lambda module: str(path))
+    return path
+
+
+def test_run_transaction_command_waits_for_lock(lock_file, monkeypatch):
+    clock = FakeClock(lambda clock: len(clock.sleeps) == 3 and lock_file.unlink())
+    monkeypatch.setattr(pacaur, 'time', clock)
+    module = FakeModule({'lock_timeout': 300})
+    result = {'lock_wait': 1.0}
+
+    assert pacaur.run_transaction_command(module, ['pacman', '-S', 'foo'], result) == (0, '', '')
+    assert clock.sleeps == [0.5, 1, 2]
+    assert module.commands == [['pacman', '-S', 'foo']]
+    assert result['lock_wait'] == 4.5
+
+
+def test_run_transaction_command_gives_up_at_deadline(lock_file, monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(pacaur, 'time', clock)
+    module = FakeModule({'lock_timeout': 3}, [(1, '', 'error: failed to init transaction (unable to lock database)')])
+    result = {}
+
+    rc, _, _ = pacaur.run_transaction_command(module, ['pacman', '-S', 'foo'], result)
+
+    assert rc == 1
+    assert clock.sleeps == [0.5, 1, 1.5]
+    assert len(module.commands) == 1
+    assert result['lock_wait'] == 3
+
+
+@pytest.mark.parametrize('args,expected', [
+    (['/usr/bin/pacman', '-S', '--needed', '--noconfirm', 'foo', 'bar'], 'pacman -S --needed'),
+    (['/usr/bin/sudo', '/usr/bin/pacman', '-R'], 'sudo pacman -R'),
+    (['/usr/bin/sudo', '-n', '/usr/bin/pacman', '-U', '--needed', 'foo.pkg.tar.zst'], 'sudo pacman -U --needed'),
+    ('/usr/bin/pacman -Q foo', 'pacman -Q'),
+    (['/usr/bin/pacman-conf', 'DBPath'], 'pacman-conf'),
+    (['whoami'], 'whoami'),
+    ([], ''),
+])
+def test_classify_command(args, expected):
+    assert pacaur.classify_command(args) == expected
+
+
+@pytest.mark.parametrize('url,expected', [
+    ('https://aur.archlinux.org/rpc/?v=5&type=info&arg=foo', 'aur.archlinux.org/rpc'),
+    ('https://aur.archlinux.org/cgit/aur.git/snapshot/foo.tar.gz', 'aur.archlinux.org/cgit'),
+    ('http://127.0.0.1:8080/', '127.0.0.1:8080/'),
+])
+def test_classify_url(url, expected):
+    assert pacaur.classify_url(url) == expected
+
+
+def test_instrumentation_phase_durations_exclude_background_workers():
+    tracker = pacaur.Instrumentation()
+    tracker.local.switched = tracker.started
+
+    def download():
+        with tracker.phase('build'):
+            time.sleep(0.2)
+
+    with tracker.phase('build'):
+        worker = threading.Thread(target=download)
+        worker.start()
+        worker.join()
+
+    metrics = tracker.finish(FakeModule({'trace_file': None}))
+
+    assert sum(item['duration'] for item in metrics['phases'].values()) <= metrics['duration']
+    assert metrics['background'] >= 0.2
+
+
+def test_parse_pacman_info_output():
+    output = 'Name            : foo\nVersion         : 1.0-1\nProvides        : bar=1.0  baz\n' \
+        '                  qux\n\nName            : quux\nVersion         : 2:3.0-1\n\n'
+
+    assert pacaur.parse_pacman_info_output(output) == [
+        {'Name': 'foo', 'Version': '1.0-1', 'Provides': 'bar=1.0  baz qux'},
+        {'Name': 'quux', 'Version': '2:3.0-1'}
+    ]
+
+
+def test_get_installed_package_versions_resolves_provides():
+    module = FakeModule(results=[(0, 'foo 1.0-1\nbar 1:2.0-1\n', ''),
+                                 (1, 'bar 1:2.0-1\n', "error: package 'missing' was not found\n")])
+
+    assert pacaur.get_installed_package_versions(module, ['foo', 'baz', 'missing'], 'pacman') == {
+        'foo': '1.0-1', 'baz': '1:2.0-1', 'missing': None}
+    assert module.commands == [['pacman', '-Q'], ['pacman', '-Q', 'baz', 'missing']]
+
+
+def test_get_package_version():
+    module = FakeModule(results=[(0, 'Name            : bar\nVersion         : 1:2.0-1\n', ''), (1, '', '')])
+
+    assert pacaur.get_package_version(module, 'baz', 'pacman') == '1:2.0-1'
+    assert pacaur.get_package_version(module, 'missing', 'pacman') is None
+    assert module.commands == [['pacman', '-Q', '-i', 'baz'], ['pacman', '-Q', '-i', 'missing']]
+
+
+@pytest.fixture
+def index_pacman(tmp_path):
+    '''
+    Fake pacman for the package index, logging its calls and printing the prepared outputs.
+    '''
+    outputs = tmp_path / 'outputs'
+    outputs.mkdir()
+    (outputs / 'Qi').write_text('Name            : foo\nVersion         : 1.0-1\nProvides        : None\n\n'
+                                'Name            : bar\nVersion         : 1:2.0-1\nProvides        : baz=2.0  qux\n\n')
+    (outputs / 'Sl').write_text('core foo 1.1-1 [installed: 1.0-1]\nextra bar 1:2.0-1 [installed]\nextra quux 3.0-1\n')
+    (outputs / 'Sgg').write_text('base-devel make\nbase-devel gcc\n')
+    pacman = tmp_path / 'pacman'
+    pacman.write_text('#!/bin/sh\necho "$*" >> {0}/calls\ncase "$*" in\n'
+                      '    "-Q -i") cat {0}/Qi ;;\n    "-S -l") cat {0}/Sl ;;\n'
+                      '    "-S -g -g") cat {0}/Sgg ;;\n    "-S -s ^quux\\$"|"-S -s ^baz\\$") ;;\n    *) exit 1 ;;\n'
+                      'esac\n'.format(outputs))
+    pacman.chmod(0o755)
+    (tmp_path / 'db' / 'local').mkdir(parents=True)
+    return pacman
+
+
+def test_package_index_query(tmp_path, index_pacman):
+    package_index = pacaur.PackageIndex(str(index_pacman), str(tmp_path / 'db'), 'http://127.0.0.1:1', 60)
+
+    assert package_index.query('installed', ['foo', 'bar', 'baz', 'qux', 'missing']) == {
+        'foo': '1.0-1', 'bar': '1:2.0-1', 'baz': '1:2.0-1', 'qux': '1:2.0-1', 'missing': None}
+    assert package_index.query('repository', ['foo', 'quux', 'missing']) == {
+        'foo': '1.1-1', 'quux': '3.0-1', 'missing': None}
+    assert package_index.query('groups', ['base-devel', 'missing']) == {'base-devel': ['make', 'gcc'], 'missing': []}
+    assert package_index.query('official', ['quux', 'baz', 'missing']) == {'quux': True, 'baz': True, 'missing': False}
+
+    with pytest.raises(ValueError):
+        package_index.query('unknown', ['foo'])
+
+
+def test_package_index_refresh(tmp_path, index_pacman):
+    package_index = pacaur.PackageIndex(str(index_pacman), str(tmp_path / 'db'), 'http://127.0.0.1:1', 60)
+    calls = tmp_path / 'outputs' / 'calls'
+
+    package_index.query('installed', ['foo'])
+    package_index.query('repository', ['foo'])
+    number_of_calls = len(calls.read_text().splitlines())
+
+    package_index.query('installed', ['foo'])
+    assert len(calls.read_text().splitlines()) == number_of_calls
+
+    (tmp_path / 'outputs' / 'Qi').write_text('Name            : foo\nVersion         : 1.1-1\n\n')
+    local_stat = os.stat(str(tmp_path / 'db' / 'local'))
+    os.utime(str(tmp_path / 'db' / 'local'), ns=(local_stat.st_atime_ns, local_stat.st_mtime_ns + 1000000000))
+
+    assert package_index.query('installed', ['foo', 'bar']) == {'foo': '1.1-1', 'bar': None}
+    assert len(calls.read_text().splitlines()) == 2 * number_of_calls
+
+
+def test_package_index_aur_query():
+    with AurServer({'foo': ('foo', '1.0-1'), 'bar': ('foobar', '2:2.0-1')}) as server:
+        package_index = pacaur.PackageIndex('pacman', '/nonexistent', server.url, 3600)
+
+        packages_info = package_index.query('aur', ['foo', 'bar', 'missing'])
+        assert packages_info['foo']['Version'] == '1.0-1'
+        assert packages_info['bar']['PackageBase'] == 'foobar'
+        assert packages_info['missing'] is None
+
+        package_index.query('aur', ['foo', 'missing'], server.url + '/')
+        assert server.requests['rpc'] == 1
+
+        with pytest.raises(ValueError):
+            package_index.query('aur', ['foo'], 'https://aur.archlinux.org')
+
+
+@pytest.fixture
+def socket_directory(tmp_path):
+    '''
+    Directory with the listening Unix socket, served by the package index helper.
+    '''
+    directory = tmp_path / 'run'
+    directory.mkdir()
+    directory.chmod(0o755)
+    return directory
+
+
+def serve_socket(socket_path, package_index):
+    server = socketserver.ThreadingUnixStreamServer(str(socket_path), pacaur.PackageIndexRequestHandler)
+    server.package_index = package_index
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def test_package_index_client_connect(socket_directory):
+    socket_path = socket_directory / 'index.sock'
+    client = pacaur.PackageIndexClient()
+
+    assert client.connect(str(socket_path)) is None
+    assert client.socket_path is None
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as listener:
+        listener.bind(str(socket_path))
+
+        assert client.connect(str(socket_path)) is None
+        assert client.socket_path == str(socket_path)
+
+        socket_directory.chmod(0o777)
+        assert 'writable by other users' in client.connect(str(socket_path))
+        assert client.socket_path is None
+
+
+def test_package_index_client_connect_rejects_foreign_socket(socket_directory, monkeypatch):
+    socket_path = socket_directory / 'index.sock'
+    client = pacaur.PackageIndexClient()
+    os_stat = os.stat
+
+    def foreign_stat(path, *args, **kwargs):
+        result = os_stat(path, *args, **kwargs)
+        uid = 4242 if os.path.abspath(str(path)) == str(socket_path) else result.st_uid
+        return os.stat_result(result[:4] + (uid,) + result[5:])
+
+    monkeypatch.setattr(pacaur.os, 'stat', foreign_stat)
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as listener:
+        listener.bind(str(socket_path))
+
+        assert 'not owned by root' in client.connect(str(socket_path))
+        assert client.socket_path is None
+
+
+def test_package_index_client_falls_back_for_another_aur(socket_directory):
+    with AurServer({'foo': ('foo', '1.0-1')}) as server:
+        socket_path = socket_directory / 'index.sock'
+        index_server = serve_socket(socket_path, pacaur.PackageIndex('pacman', '/nonexistent', server.url, 3600))
+        client = pacaur.PackageIndexClient()
+
+        try:
+            assert client.connect(str(socket_path)) is None
+            assert client.query('aur', ['foo'], 'https://aur.archlinux.org') is None
+            assert client.socket_path == str(socket_path)
+            assert client.query('aur', ['foo'], server.url)['foo']['Version'] == '1.0-1'
+        finally:
+            index_server.shutdown()
+            index_server.server_close()
+
+
+def test_get_local_package_info_falls_back_to_pacman(tmp_path):
+    file_name = tmp_path / 'foo-1:2.0-1-any.pkg.tar.gz'
+    file_name.write_bytes(b'not a gzip stream')
+    module = FakeModule(results=[(0, 'foo 1:2.0-1\n', '')])
+
+    assert pacaur.get_local_package_info(module, str(file_name), 'pacman') == ('foo', '1:2.0-1')
+    assert module.commands == [['pacman', '-Q', '-p', str(file_name)]]
+
+
+def test_get_local_package_info_does_not_hide_bugs(tmp_path, monkeypatch):
+    def read_local_package_info(file_name):
+        raise TypeError('bug')
+
+    monkeypatch.setattr(pacaur, 'read_local_package_info', read_local_package_info)
+
+    with pytest.raises(TypeError):
+        pacaur.get_local_package_info(FakeModule(), build_package_file(tmp_path, 'gz'), 'pacman')
+
+
+def test_prune_package_caches_warns_about_skipped_directories(tmp_path, monkeypatch):
+    writable = tmp_path / 'pkg'
+    read_only = tmp_path / 'readonly'
+    build_directory = tmp_path / 'aur' / 'foo'
+
+    for directory in (writable, read_only, build_directory):
+        directory.mkdir(parents=True)
+        create_cached_files(directory, ['foo-1.0-1-x86_64.pkg.tar.zst', 'foo-2.0-1-x86_64.pkg.tar.zst'])
+
+    monkeypatch.setattr(pacaur, 'get_pacman_cache_directories', lambda module: [str(writable), str(read_only)])
+    monkeypatch.setattr(pacaur.os, 'access', lambda path, mode: path != str(read_only))
+    module = FakeModule({'cache_retention': 1, 'aur_cache_dir': str(tmp_path / 'aur')})
+    result = {}
+
+    pacaur.prune_package_caches(module, result)
+
+    assert result['reclaimed_bytes'] == 2
+    assert len(list(read_only.iterdir())) == 2
+    assert [str(read_only) in item for item in module.warnings] == [True]
+
+
+
+def test_run_transaction_command_backs_off_between_retries(lock_file, monkeypatch):
+    # pacman reports the lock that is not visible at the computed path, eg. inside another root directory.
+    lock_file.unlink()
+    clock = FakeClock()
+    monkeypatch.setattr(pacaur, 'time', clock)
+    error = (1, '', 'error: failed to init transaction (unable to lock database)')
+    module = FakeModule({'lock_timeout': 300}, [error, error, (0, 'done', '')])
+    result = {}
+
+    assert pacaur.run_transaction_command(module, ['pacman', '-S', 'foo'], result) == (0, 'done', '')
+    assert clock.sleeps == [0.5, 1]
+    assert len(module.commands) == 3
+    assert result['lock_wait'] == 1.5
+
+
+def test_get_pacman_config_values_is_memoized(monkeypatch):
+    monkeypatch.setattr(pacaur, 'pacman_config_values', {})
+    module = FakeModule(results=[(0, '/var/lib/pacman/\n', ''), (0, '/var/cache/pacman/pkg/\n/srv/pkg/\n', '')])
+    module.get_bin_path = lambda name, required=False: '/usr/bin/{}'.format(name)
+
+    for _ in range(2):
+        assert pacaur.get_pacman_lock_file(module) == '/var/lib/pacman/db.lck'
+        assert pacaur.get_pacman_config_values(module, 'CacheDir') == ['/var/cache/pacman/pkg/', '/srv/pkg/']
+
+    assert module.commands == [['/usr/bin/pacman-conf', 'DBPath'], ['/usr/bin/pacman-conf', 'CacheDir']]